@@ -1,19 +1,20 @@
-import psycopg2
+from psycopg2.pool import SimpleConnectionPool
 import pandas as pd
 import numpy as np
 from datetime import datetime
 import argparse
+import io
 import sys
 
 def connect_database(db_config):
     try:
-        conn = psycopg2.connect(**db_config)
-        return conn
+        pool = SimpleConnectionPool(1, 2, connect_timeout=2, keepalives=1, **db_config)
+        return pool
     except Exception as e:
         print(f"Database connection error: {e}")
         sys.exit(1)
 
-def extract_experiment_data(conn, min_samples=50):
+def extract_experiment_data(pool, min_samples=50):
     query = """
     SELECT 
         event_id,
@@ -30,33 +31,49 @@ def extract_experiment_data(conn, min_samples=50):
     LIMIT %s
     """
     
-    df = pd.read_sql_query(query, conn, params=(min_samples * 2,))
+    # Stream the result set as CSV through COPY and let pandas' C parser
+    # build the frame, instead of converting row objects one by one.
+    buf = io.StringIO()
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as cursor:
+            select = cursor.mogrify(query, (min_samples * 2,)).decode()
+            cursor.copy_expert(f"COPY ({select}) TO STDOUT WITH (FORMAT CSV, HEADER)", buf)
+    finally:
+        pool.putconn(conn)
+    
+    buf.seek(0)
+    df = pd.read_csv(buf, dtype={'fill_level_ml': np.float64, 'cycle_time_ms': np.int64})
     
     print(f"Extracted {len(df)} successful fill cycles from database")
     return df
 
-def analyze_performance(df, requirement_min=600, requirement_max=1500):
-    cycle_times = df['cycle_time_ms'].values
+def analyze_performance(cycle_times, requirement_min=600, requirement_max=1500):
+    # One selection pass for all order statistics instead of five.
+    q0, q25, q50, q75, q100 = np.quantile(cycle_times, [0.0, 0.25, 0.5, 0.75, 1.0])
+    mean = cycle_times.mean()
+    std = cycle_times.std()
     
     stats = {
         'count': len(cycle_times),
-        'mean': np.mean(cycle_times),
-        'std': np.std(cycle_times),
-        'min': np.min(cycle_times),
-        'max': np.max(cycle_times),
-        'median': np.median(cycle_times),
-        'q25': np.percentile(cycle_times, 25),
-        'q75': np.percentile(cycle_times, 75),
+        'mean': mean,
+        'std': std,
+        'min': q0,
+        'max': q100,
+        'median': q50,
+        'q25': q25,
+        'q75': q75,
     }
     
-    within_spec = np.sum((cycle_times >= requirement_min) & (cycle_times <= requirement_max))
+    within_spec = np.count_nonzero((cycle_times >= requirement_min) & (cycle_times <= requirement_max))
     stats['within_spec_count'] = within_spec
     stats['within_spec_percent'] = (within_spec / len(cycle_times)) * 100
     
-    stats['ci_95_lower'] = stats['mean'] - 1.96 * (stats['std'] / np.sqrt(len(cycle_times)))
-    stats['ci_95_upper'] = stats['mean'] + 1.96 * (stats['std'] / np.sqrt(len(cycle_times)))
+    half_width = 1.96 * (std / np.sqrt(len(cycle_times)))
+    stats['ci_95_lower'] = mean - half_width
+    stats['ci_95_upper'] = mean + half_width
     
-    return stats, cycle_times
+    return stats
 
 def print_results(stats, requirement_min=600, requirement_max=1500):
     print("\n" + "=" * 70)
@@ -127,21 +144,22 @@ def main():
         'password': args.password
     } 
 
-    conn = connect_database(db_config)
+    pool = connect_database(db_config)
     
-    df = extract_experiment_data(conn, min_samples=args.runs)
+    df = extract_experiment_data(pool, min_samples=args.runs)
     
     if len(df) < args.runs:
         print(f"\nWarning: Only {len(df)} samples available (requested {args.runs})")
         print("Consider running the system longer to collect more data")
     
-    stats, cycle_times = analyze_performance(df)
+    cycle_times = df['cycle_time_ms'].to_numpy(dtype=np.float64)
+    stats = analyze_performance(cycle_times)
     
     print_results(stats)
     
     save_results(df, stats, args.output)
     
-    conn.close()
+    pool.closeall()
 
 if __name__ == "__main__":
     main()
@@ -1,11 +1,75 @@
 import paho.mqtt.client as mqtt
-import psycopg2
-from psycopg2.extras import RealDictCursor
-import json
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extras import execute_batch
+import orjson
+import io
+import logging
+import logging.handlers
+import os
+import queue
+import signal
+import threading
 import time
 from datetime import datetime
 from enum import Enum
 
+log = logging.getLogger(__name__)
+
+# Prepared once on the writer connection so the server skips parse/plan
+# on every insert.
+PREPARE_LOG_EVENT = """
+    PREPARE log_evt (timestamp, varchar, integer, numeric, numeric, integer,
+                     integer, varchar, varchar, varchar, text, varchar) AS
+    INSERT INTO filling_events 
+    (timestamp, event_type, can_id, position_mm, fill_level_ml, cycle_time_ms, 
+     fill_duration_ms, valve_state, sensor_status, fault_code, 
+     fault_description, system_state)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12)
+"""
+EXECUTE_LOG_EVENT = "EXECUTE log_evt (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
+
+# Column order of the rows built by log_event, used for COPY.
+EVENT_COLUMNS = (
+    'timestamp', 'event_type', 'can_id', 'position_mm', 'fill_level_ml', 'cycle_time_ms',
+    'fill_duration_ms', 'valve_state', 'sensor_status', 'fault_code',
+    'fault_description', 'system_state'
+)
+
+_COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+def _copy_field(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value).translate(_COPY_ESCAPES)
+
+# valve/command payloads have a fixed shape, so they are filled in from
+# byte templates: timestamp first, then the JSON-encoded arguments.
+VALVE_OPEN = b'{"timestamp":"%b","action":"open","can_id":%b}'
+VALVE_CLOSE = b'{"timestamp":"%b","action":"close","can_id":%b,"final_level":%b}'
+VALVE_FAULT_CLOSE = b'{"timestamp":"%b","action":"close","reason":"fault","can_id":%b}'
+
+# Control markers for the event writer queue.
+_FLUSH = object()
+_STOP = object()
+
+def _start_log_listener():
+    # Put the handlers configured in __main__ behind a queue so the MQTT
+    # and timer threads only enqueue records; the stream writes happen on
+    # the listener's own thread.
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    if not handlers:
+        return None
+    for handler in handlers:
+        root.removeHandler(handler)
+    log_queue = queue.SimpleQueue()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
 class SystemState(Enum):
     IDLE = "idle"
     WAITING_POSITION = "waiting_position"
@@ -24,93 +88,223 @@ class FillController:
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
         
+        self._handlers = {
+            "sensor/can_detected": self.handle_can_detected,
+            "sensor/position": self.handle_position_data,
+            "sensor/level": self.handle_level_data,
+            "sensor/level/config": self.handle_level_config,
+        }
+        
         self.state = SystemState.IDLE
         self.current_can_id = None
         self.position_mm = None
         self.current_level = 0
         self.target_level = 330
         self.tolerance = 5
+        self.sensor_level_config = None
+        
+        # Level checks compare integer tenths of a millilitre, the unit the
+        # sensor reports in; the bounds are fixed when filling starts.
+        self.current_level_tenths = 0
+        self._level_low_tenths = None
+        self._level_high_tenths = None
         
-        self.cycle_start_time = None
-        self.fill_start_time = None
+        # Monotonic nanosecond timestamps; each timeout is turned into an
+        # integer deadline when its phase starts.
+        self.cycle_start_ns = None
+        self.fill_start_ns = None
+        self._position_deadline_ns = None
+        self._fill_deadline_ns = None
         
         self.position_timeout = 0.2
         self.sensor_timeout = 0.2
         self.max_fill_time = 3.0
+        self.valve_close_delay = 0.03
+        self.complete_hold_time = 0.5
+        self.fault_recovery_time = 2.0
         
-        self.db_conn = None
+        # Serialises state transitions between the MQTT thread and timers.
+        self._state_lock = threading.RLock()
+        
+        self.db_pool = None
+        self.event_batch_size = 200
+        self.event_flush_interval = 1.0
+        self.copy_threshold = 16
+        self._event_queue = queue.Queue(maxsize=10000)
+        self._dropped_events = 0
+        self._writer_thread = None
+        self._writer_conn = None
+        self._writer_cur = None
         
     def connect_database(self):
         try:
-            self.db_conn = psycopg2.connect(**self.db_config)
-            print(f"[{datetime.now()}] Connected to database")
+            self.db_pool = ThreadedConnectionPool(1, 4, connect_timeout=2, keepalives=1,
+                                                  **self.db_config)
+            log.info("Connected to database")
         except Exception as e:
-            print(f"Database connection error: {e}")
+            log.error("Database connection error: %s", e)
             
     def log_event(self, event_type, **kwargs):
-        if not self.db_conn:
+        if not self.db_pool:
+            return
+        
+        # Snapshot everything (including the event time) now; the row is
+        # written later by the writer thread.
+        row = (
+            datetime.now(),
+            event_type,
+            kwargs.get('can_id', self.current_can_id),
+            kwargs.get('position_mm', self.position_mm),
+            kwargs.get('fill_level', self.current_level),
+            kwargs.get('cycle_time_ms'),
+            kwargs.get('fill_duration_ms'),
+            kwargs.get('valve_state'),
+            kwargs.get('sensor_status'),
+            kwargs.get('fault_code'),
+            kwargs.get('fault_description'),
+            self.state.value
+        )
+        
+        # Never block the MQTT thread on the database; if the writer has
+        # fallen this far behind, drop the event and count it.
+        try:
+            self._event_queue.put_nowait(row)
+        except queue.Full:
+            self._dropped_events += 1
+            if self._dropped_events % 1000 == 1:
+                log.warning("Event queue full, %d events dropped so far", self._dropped_events)
+    
+    def flush_events(self):
+        if not self.db_pool:
             return
-            
         try:
-            cursor = self.db_conn.cursor()
+            self._event_queue.put_nowait(_FLUSH)
+        except queue.Full:
+            pass
+    
+    def _acquire_writer(self):
+        self._writer_conn = self.db_pool.getconn()
+        self._writer_conn.autocommit = False
+        self._writer_cur = self._writer_conn.cursor()
+        self._writer_cur.execute(PREPARE_LOG_EVENT)
+    
+    def _release_writer(self, discard=False):
+        if self._writer_conn is None:
+            return
+        if self._writer_cur is not None and not self._writer_cur.closed:
+            self._writer_cur.close()
+        self.db_pool.putconn(self._writer_conn, close=discard)
+        self._writer_conn = None
+        self._writer_cur = None
+    
+    def _write_events(self, rows):
+        if not rows:
+            return
+        
+        try:
+            if self._writer_conn is None:
+                self._acquire_writer()
+            # COPY streams rows without per-statement overhead but has a
+            # fixed setup cost; small batches are cheaper as EXECUTEs.
+            # Large batches come from rows queueing up while a previous
+            # write or commit is slow (rows from a failed write are dropped,
+            # not retried).
+            if len(rows) >= self.copy_threshold:
+                buf = io.StringIO(''.join(
+                    '\t'.join(_copy_field(v) for v in row) + '\n' for row in rows))
+                self._writer_cur.copy_from(buf, 'filling_events', columns=EVENT_COLUMNS)
+            else:
+                execute_batch(self._writer_cur, EXECUTE_LOG_EVENT, rows, page_size=self.event_batch_size)
+            self._writer_conn.commit()
             
-            query = """
-                INSERT INTO filling_events 
-                (event_type, can_id, position_mm, fill_level_ml, cycle_time_ms, 
-                 fill_duration_ms, valve_state, sensor_status, fault_code, 
-                 fault_description, system_state)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """
+        except Exception as e:
+            log.error("Error logging %d events: %s", len(rows), e)
+            # Drop the connection rather than reuse it in an unknown state;
+            # the next write takes a fresh one from the pool and prepares it.
+            self._release_writer(discard=True)
+    
+    def _writer_loop(self):
+        # Collect rows until the batch is full, event_flush_interval has
+        # passed since the first one, or a flush/stop marker arrives. At
+        # each flush, whatever else is already queued goes into the same
+        # write, so a backlog is committed in one go rather than cut up
+        # at every per-can flush marker.
+        rows = []
+        deadline = None
+        
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._event_queue.get(timeout=timeout)
+            except queue.Empty:
+                item = _FLUSH
             
-            values = (
-                event_type,
-                kwargs.get('can_id', self.current_can_id),
-                kwargs.get('position_mm', self.position_mm),
-                kwargs.get('fill_level', self.current_level),
-                kwargs.get('cycle_time_ms'),
-                kwargs.get('fill_duration_ms'),
-                kwargs.get('valve_state'),
-                kwargs.get('sensor_status'),
-                kwargs.get('fault_code'),
-                kwargs.get('fault_description'),
-                self.state.value
-            )
+            if item is not _FLUSH and item is not _STOP:
+                rows.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.event_flush_interval
+                if len(rows) < self.event_batch_size:
+                    continue
             
-            cursor.execute(query, values)
-            self.db_conn.commit()
-            cursor.close()
+            stop = item is _STOP
+            while not stop:
+                try:
+                    item = self._event_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                elif item is not _FLUSH:
+                    rows.append(item)
             
-        except Exception as e:
-            print(f"Error logging event: {e}")
-            if self.db_conn:
-                self.db_conn.rollback()
+            self._write_events(rows)
+            if stop:
+                return
+            rows = []
+            deadline = None
+    
+    def _publish_valve(self, template, *values):
+        payload = template % (datetime.now().isoformat().encode(), *map(orjson.dumps, values))
+        self.client.publish("valve/command", payload, qos=1)
+    
+    def _schedule(self, delay, callback):
+        # Run callback after delay on a timer thread, holding the state lock,
+        # so waits never block the MQTT network thread.
+        def fire():
+            with self._state_lock:
+                callback()
+        
+        timer = threading.Timer(delay, fire)
+        timer.daemon = True
+        timer.start()
     
     def on_connect(self, client, userdata, flags, rc):
-        print(f"[{datetime.now()}] Fill Controller connected to MQTT broker (rc={rc})")
-        client.subscribe("sensor/can_detected")
-        client.subscribe("sensor/position")
-        client.subscribe("sensor/level")
+        log.info("Fill Controller connected to MQTT broker (rc=%s)", rc)
+        # Brokers deliver at min(publish QoS, subscribe QoS): subscribing at
+        # 1 keeps can_detected/position acknowledged end to end while
+        # sensor/level, published at 0, stays fire-and-forget. One wildcard
+        # covers every handled topic; anything else under sensor/ is
+        # dropped by the dispatch in on_message.
+        client.subscribe("sensor/#", qos=1)
         
     def on_message(self, client, userdata, msg):
         try:
-            payload = json.loads(msg.payload.decode())
-            
-            if msg.topic == "sensor/can_detected":
-                self.handle_can_detected(payload)
-            elif msg.topic == "sensor/position":
-                self.handle_position_data(payload)
-            elif msg.topic == "sensor/level":
-                self.handle_level_data(payload)
+            handler = self._handlers.get(msg.topic)
+            if handler:
+                payload = orjson.loads(msg.payload)
+                with self._state_lock:
+                    handler(payload)
                 
         except Exception as e:
-            print(f"Error processing message: {e}")
+            log.error("Error processing message: %s", e)
     
     def handle_can_detected(self, data):
         if self.state == SystemState.IDLE:
             self.current_can_id = data.get('can_id')
-            self.cycle_start_time = time.time()
+            self.cycle_start_ns = time.monotonic_ns()
+            self._position_deadline_ns = self.cycle_start_ns + int(self.position_timeout * 1e9)
             self.state = SystemState.WAITING_POSITION
-            print(f"[{datetime.now()}] State: IDLE -> WAITING_POSITION (Can #{self.current_can_id})")
+            log.info("State: IDLE -> WAITING_POSITION (Can #%s)", self.current_can_id)
             
             self.log_event('can_detected', can_id=self.current_can_id)
             
@@ -119,11 +313,11 @@ class FillController:
             self.position_mm = data.get('position_mm')
             is_valid = data.get('valid', False)
             
-            elapsed = time.time() - self.cycle_start_time
+            now_ns = time.monotonic_ns()
             
-            if elapsed > self.position_timeout:
+            if now_ns > self._position_deadline_ns:
                 self.enter_fault_state('position_timeout', 
-                    f"Position detection timeout ({elapsed*1000:.0f}ms > {self.position_timeout*1000}ms)")
+                    f"Position detection timeout ({(now_ns - self.cycle_start_ns) / 1e6:.0f}ms > {self.position_timeout*1000}ms)")
                 return
                 
             if not is_valid:
@@ -132,62 +326,67 @@ class FillController:
                 return
             
             self.state = SystemState.FILLING
-            self.fill_start_time = time.time()
-            print(f"[{datetime.now()}] State: WAITING_POSITION -> FILLING")
-            print(f"[{datetime.now()}] Position validated: {self.position_mm:.2f}mm")
+            self.fill_start_ns = now_ns
+            self._fill_deadline_ns = now_ns + int(self.max_fill_time * 1e9)
+            self._level_low_tenths = round((self.target_level - self.tolerance) * 10)
+            self._level_high_tenths = round((self.target_level + self.tolerance) * 10)
+            log.info("State: WAITING_POSITION -> FILLING")
+            log.info("Position validated: %.2fmm", self.position_mm)
             
-            valve_cmd = {
-                "timestamp": datetime.now().isoformat(),
-                "action": "open",
-                "can_id": self.current_can_id
-            }
-            self.client.publish("valve/command", json.dumps(valve_cmd), qos=1)
+            self._publish_valve(VALVE_OPEN, self.current_can_id)
             
             self.log_event('fill_start', position_mm=self.position_mm, valve_state='opening')
             
+    def handle_level_config(self, data):
+        self.sensor_level_config = data
+        if (data.get('target') != self.target_level or
+                data.get('tolerance') != self.tolerance):
+            log.warning("Level sensor configured for %s±%sml, controller expects %s±%sml",
+                        data.get('target'), data.get('tolerance'), self.target_level, self.tolerance)
+    
     def handle_level_data(self, data):
         if self.state == SystemState.FILLING:
-            self.current_level = data.get('level_ml', 0)
+            # Levels arrive as integer tenths of a millilitre.
+            self.current_level_tenths = data.get('l', 0)
+            self.current_level = self.current_level_tenths / 10
+            log.debug("Level: %.1fml (%d samples)", self.current_level, len(data.get('s', ())))
             
-            elapsed = time.time() - self.fill_start_time
+            now_ns = time.monotonic_ns()
             
-            if elapsed > self.max_fill_time:
+            if now_ns > self._fill_deadline_ns:
                 self.enter_fault_state('fill_timeout', 
-                    f"Fill timeout ({elapsed*1000:.0f}ms > {self.max_fill_time*1000}ms)")
+                    f"Fill timeout ({(now_ns - self.fill_start_ns) / 1e6:.0f}ms > {self.max_fill_time*1000}ms)")
                 return
             
-            if self.current_level >= (self.target_level - self.tolerance):
+            # Only the close trigger; whether the final level is acceptable
+            # is decided in verify_completion.
+            if self.current_level_tenths >= self._level_low_tenths:
                 self.state = SystemState.CLOSING_VALVE
-                print(f"[{datetime.now()}] State: FILLING -> CLOSING_VALVE")
-                print(f"[{datetime.now()}] Target reached: {self.current_level:.1f}ml")
+                log.info("State: FILLING -> CLOSING_VALVE")
+                log.info("Target reached: %.1fml", self.current_level)
                 
-                valve_cmd = {
-                    "timestamp": datetime.now().isoformat(),
-                    "action": "close",
-                    "can_id": self.current_can_id,
-                    "final_level": self.current_level
-                }
-                self.client.publish("valve/command", json.dumps(valve_cmd), qos=1)
+                self._publish_valve(VALVE_CLOSE, self.current_can_id, self.current_level)
                 
-                time.sleep(0.03)
-                
-                self.verify_completion()
+                # Give the valve time to close without blocking the MQTT
+                # network thread.
+                self._schedule(self.valve_close_delay, self.verify_completion)
     
     def verify_completion(self):
         if self.state == SystemState.CLOSING_VALVE:
-            within_tolerance = (self.target_level - self.tolerance <= self.current_level <= 
-                               self.target_level + self.tolerance)
+            within_tolerance = (self._level_low_tenths <= self.current_level_tenths <=
+                                self._level_high_tenths)
             
-            cycle_time = (time.time() - self.cycle_start_time) * 1000
-            fill_time = (time.time() - self.fill_start_time) * 1000
+            now_ns = time.monotonic_ns()
+            cycle_time = (now_ns - self.cycle_start_ns) / 1e6
+            fill_time = (now_ns - self.fill_start_ns) / 1e6
             
             if within_tolerance:
                 self.state = SystemState.COMPLETE
-                print(f"[{datetime.now()}] State: CLOSING_VALVE -> COMPLETE")
-                print(f"[{datetime.now()}] SUCCESS: Can #{self.current_can_id}")
-                print(f"  Final level: {self.current_level:.1f}ml (target: {self.target_level}±{self.tolerance}ml)")
-                print(f"  Cycle time: {cycle_time:.0f}ms")
-                print(f"  Fill time: {fill_time:.0f}ms")
+                log.info("State: CLOSING_VALVE -> COMPLETE")
+                log.info("SUCCESS: Can #%s", self.current_can_id)
+                log.info("  Final level: %.1fml (target: %s±%sml)", self.current_level, self.target_level, self.tolerance)
+                log.info("  Cycle time: %.0fms", cycle_time)
+                log.info("  Fill time: %.0fms", fill_time)
                 
                 self.log_event('fill_complete', 
                     fill_level=self.current_level,
@@ -196,70 +395,88 @@ class FillController:
                     valve_state='closed',
                     sensor_status='normal')
                 
-                time.sleep(0.5)
-                self.reset_for_next_can()
+                self._schedule(self.complete_hold_time, self.reset_for_next_can)
             else:
                 self.enter_fault_state('out_of_tolerance', 
                     f"Final level {self.current_level:.1f}ml outside tolerance ({self.target_level}±{self.tolerance}ml)")
     
     def enter_fault_state(self, fault_code, description):
         self.state = SystemState.FAULT
-        print(f"[{datetime.now()}] State: -> FAULT")
-        print(f"  Fault code: {fault_code}")
-        print(f"  Description: {description}")
+        log.warning("State: -> FAULT")
+        log.warning("  Fault code: %s", fault_code)
+        log.warning("  Description: %s", description)
         
-        valve_cmd = {
-            "timestamp": datetime.now().isoformat(),
-            "action": "close",
-            "reason": "fault",
-            "can_id": self.current_can_id
-        }
-        self.client.publish("valve/command", json.dumps(valve_cmd), qos=1)
+        self._publish_valve(VALVE_FAULT_CLOSE, self.current_can_id)
         
         self.log_event('fault_detected', 
             fault_code=fault_code,
             fault_description=description,
             valve_state='emergency_close')
+        self.flush_events()
         
-        time.sleep(2)
-        self.reset_for_next_can()
+        self._schedule(self.fault_recovery_time, self.reset_for_next_can)
     
     def reset_for_next_can(self):
+        self.flush_events()
         self.state = SystemState.IDLE
         self.current_can_id = None
         self.position_mm = None
         self.current_level = 0
-        self.cycle_start_time = None
-        self.fill_start_time = None
-        print(f"[{datetime.now()}] State: -> IDLE (ready for next can)")
-        print("=" * 70)
+        self.current_level_tenths = 0
+        self.cycle_start_ns = None
+        self.fill_start_ns = None
+        self._position_deadline_ns = None
+        self._fill_deadline_ns = None
+        log.info("State: -> IDLE (ready for next can)")
+        log.info("=" * 70)
+    
+    def stop(self, signum=None, frame=None):
+        log.info("Shutting down fill controller...")
+        # Makes loop_forever() return so run() can clean up.
+        self.client.disconnect()
     
     def run(self):
+        listener = _start_log_listener()
         self.connect_database()
+        if self.db_pool:
+            self._writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+            self._writer_thread.start()
         
-        self.client.connect(self.broker, self.port, 60)
-        self.client.loop_start()
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
         
-        print(f"[{datetime.now()}] Fill Controller started")
-        print(f"Configuration:")
-        print(f"  Target level: {self.target_level}±{self.tolerance}ml")
-        print(f"  Max fill time: {self.max_fill_time}s")
-        print(f"  Position timeout: {self.position_timeout}s")
-        print("=" * 70)
+        self.client.connect_async(self.broker, self.port, 60)
+        
+        log.info("Fill Controller started")
+        log.info("Configuration:")
+        log.info("  Target level: %s±%sml", self.target_level, self.tolerance)
+        log.info("  Max fill time: %ss", self.max_fill_time)
+        log.info("  Position timeout: %ss", self.position_timeout)
+        log.info("=" * 70)
         
         try:
-            while True:
-                time.sleep(0.1)
-                
-        except KeyboardInterrupt:
-            print("Shutting down fill controller...")
-            if self.db_conn:
-                self.db_conn.close()
-            self.client.loop_stop()
-            self.client.disconnect()
+            # The network loop runs on this thread and wakes on socket
+            # activity instead of a polling sleep.
+            self.client.loop_forever(retry_first_connection=True)
+        finally:
+            if self._writer_thread:
+                try:
+                    # A full queue (e.g. database unreachable) must not hold
+                    # up shutdown; the unwritten events are lost either way.
+                    self._event_queue.put(_STOP, timeout=1)
+                    self._writer_thread.join(timeout=5)
+                except queue.Full:
+                    log.warning("Event queue full at shutdown; %d events not written",
+                                self._event_queue.qsize())
+            if self.db_pool:
+                self._release_writer()
+                self.db_pool.closeall()
+            if listener:
+                listener.stop()
 
 if __name__ == "__main__":
-    import os
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+                        format="[%(asctime)s] %(message)s")
     
     broker = os.getenv('MQTT_BROKER', 'localhost')
     port = int(os.getenv('MQTT_PORT', 1883))
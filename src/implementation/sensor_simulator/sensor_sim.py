@@ -1,127 +1,221 @@
 import paho.mqtt.client as mqtt
-import json
-import time
+import orjson
+import logging
+import logging.handlers
+import os
+import queue
 import random
+import signal
+import threading
+import time
 from datetime import datetime
 
+log = logging.getLogger(__name__)
+
+def _start_log_listener():
+    # Put the handlers configured in __main__ behind a queue so the MQTT
+    # and timer threads only enqueue records; the stream writes happen on
+    # the listener's own thread.
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    if not handlers:
+        return None
+    for handler in handlers:
+        root.removeHandler(handler)
+    log_queue = queue.SimpleQueue()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
 class SensorSimulator:
-    def __init__(self, broker='localhost', port=1883):
+    def __init__(self, broker='localhost', port=1883, seed=None):
         self.broker = broker
         self.port = port
+        self.rng = random.Random(seed)
         self.client = mqtt.Client(client_id="sensor_simulator")
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
+        self.client.max_queued_messages_set(1000)
+        
+        self._handlers = {
+            "valve/command": self.handle_valve_command,
+        }
         
         self.can_detected = False
         self.filling_active = False
         self.current_level = 0
         self.position_mm = 0
         self.can_counter = 0
+        self.level_batch_size = 5
+        self.level_target = 330.0
+        self.level_tolerance = 5.0
+        self.valve_response_timeout = 1.0
+        self._samples = None
+        self._level_message = None
+        
+        # Valve commands (MQTT thread) and the can/level timers share state.
+        self._lock = threading.RLock()
         
     def on_connect(self, client, userdata, flags, rc):
-        print(f"[{datetime.now()}] Sensor Simulator connected to MQTT broker (rc={rc})")
-        client.subscribe("valve/command")
-        client.subscribe("system/control")
+        log.info("Sensor Simulator connected to MQTT broker (rc=%s)", rc)
+        client.subscribe([("valve/command", 1), ("system/control", 0)])
+        # Static level-sensor settings are published once, retained, instead
+        # of riding along on every sensor/level message.
+        config = {"target": self.level_target, "tolerance": self.level_tolerance}
+        client.publish("sensor/level/config", orjson.dumps(config), qos=1, retain=True)
         
     def on_message(self, client, userdata, msg):
         try:
-            payload = json.loads(msg.payload.decode())
-            
-            if msg.topic == "valve/command":
-                if payload.get("action") == "open":
-                    self.filling_active = True
-                    self.current_level = 0
-                    print(f"[{datetime.now()}] Valve opened - starting fill")
-                elif payload.get("action") == "close":
-                    self.filling_active = False
-                    print(f"[{datetime.now()}] Valve closed - final level: {self.current_level}ml")
+            handler = self._handlers.get(msg.topic)
+            if handler:
+                handler(orjson.loads(msg.payload))
                     
         except Exception as e:
-            print(f"Error processing message: {e}")
+            log.error("Error processing message: %s", e)
+    
+    def handle_valve_command(self, data):
+        with self._lock:
+            if data.get("action") == "open":
+                # valve/command is QoS 1, so an "open" may be redelivered;
+                # a second one must not start another level stream.
+                if self.filling_active:
+                    return
+                self.filling_active = True
+                self.current_level = 0
+                self._start_level_stream()
+                log.info("Valve opened - starting fill")
+            elif data.get("action") == "close":
+                self.filling_active = False
+                log.info("Valve closed - final level: %sml", self.current_level)
+                if self.can_detected and data.get("can_id") == self.can_counter:
+                    self.release_can()
+    
+    def _schedule(self, delay, callback):
+        timer = threading.Timer(delay, callback)
+        timer.daemon = True
+        timer.start()
+    
+    def _schedule_next_can(self):
+        self._schedule(self.rng.uniform(0.8, 2.5), self.generate_can_arrival)
+    
+    def release_can(self):
+        self.can_detected = False
+        self.current_level = 0
+        log.info("Can #%d released", self.can_counter)
+        log.info("-" * 60)
+        self._schedule_next_can()
     
     def generate_can_arrival(self):
-        time.sleep(random.uniform(0.8, 2.5))
-        
-        self.can_counter += 1
-        self.can_detected = True
-        self.position_mm = random.gauss(0, 0.8)
+        with self._lock:
+            self.can_counter += 1
+            can_id = self.can_counter
+            self.can_detected = True
+            self.position_mm = self.rng.gauss(0, 0.8)
         
         message = {
-            "timestamp": datetime.now().isoformat(),
-            "can_id": self.can_counter,
+            "timestamp": datetime.now(),
+            "can_id": can_id,
             "detected": True
         }
         
-        self.client.publish("sensor/can_detected", json.dumps(message), qos=1)
-        print(f"[{datetime.now()}] Can #{self.can_counter} detected")
-        
-        time.sleep(0.02)
+        self.client.publish("sensor/can_detected", orjson.dumps(message), qos=1)
+        log.info("Can #%d detected", can_id)
         
+        self._schedule(0.02, self.publish_position)
+        self._schedule(self.valve_response_timeout, lambda: self._check_valve_response(can_id))
+    
+    def _check_valve_response(self, can_id):
+        # The controller ignores cans while it is holding COMPLETE/FAULT;
+        # without a valve command nothing else would release this one.
+        with self._lock:
+            if self.can_detected and self.can_counter == can_id and not self.filling_active:
+                log.warning("No valve command for can #%d", can_id)
+                self.release_can()
+    
+    def publish_position(self):
         position_message = {
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": datetime.now(),
             "can_id": self.can_counter,
             "position_mm": round(self.position_mm, 2),
             "valid": abs(self.position_mm) <= 2.0
         }
         
-        self.client.publish("sensor/position", json.dumps(position_message), qos=1)
-        print(f"[{datetime.now()}] Position: {self.position_mm:.2f}mm (valid={position_message['valid']})")
-        
-    def simulate_filling(self):
-        while self.filling_active and self.current_level < 340:
-            time.sleep(0.05)
-            
-            fill_rate = random.gauss(1.5, 0.2)
-            self.current_level += fill_rate
+        self.client.publish("sensor/position", orjson.dumps(position_message), qos=1)
+        log.info("Position: %.2fmm (valid=%s)", self.position_mm, position_message['valid'])
+    
+    def _start_level_stream(self):
+        # Level samples are sent in batches of level_batch_size, except
+        # that once the level is within tolerance of the target every
+        # tick is sent immediately so the controller can close on time.
+        # Payload: {"c": can id, "l": latest level, "s": [levels since the
+        # last message]}, levels as integer tenths of a millilitre, one
+        # sample per 50ms tick.
+        self._samples = []
+        self._level_message = {"c": self.can_counter, "l": None, "s": self._samples}
+        self._schedule(0.05, self._emit_level)
+    
+    def _emit_level(self):
+        with self._lock:
+            if not self.filling_active:
+                return
             
-            level_message = {
-                "timestamp": datetime.now().isoformat(),
-                "can_id": self.can_counter,
-                "level_ml": round(self.current_level, 2),
-                "target": 330.0,
-                "tolerance": 5.0
-            }
+            self.current_level += self.rng.gauss(1.5, 0.2)
+            level = round(self.current_level * 10)
+            samples = self._samples
+            samples.append(level)
             
-            self.client.publish("sensor/level", json.dumps(level_message), qos=1)
+            if (len(samples) >= self.level_batch_size or
+                    self.current_level >= self.level_target - self.level_tolerance):
+                level_message = self._level_message
+                level_message["l"] = level
+                # Level samples supersede each other, so a lost one costs nothing;
+                # skip the PUBACK round-trip. Detection, position and valve
+                # commands stay at QoS 1.
+                self.client.publish("sensor/level", orjson.dumps(level_message), qos=0)
+                samples.clear()
             
             if self.current_level >= 325:
-                print(f"[{datetime.now()}] Level: {self.current_level:.1f}ml")
+                log.debug("Level: %.1fml", self.current_level)
+            
+            # The can overflows at 340ml; stop the stream and wait for the
+            # controller to close the valve.
+            if self.current_level < 340:
+                self._schedule(0.05, self._emit_level)
+    
+    def stop(self, signum=None, frame=None):
+        log.info("Shutting down sensor simulator...")
+        self.client.disconnect()
     
     def run(self):
-        self.client.connect(self.broker, self.port, 60)
-        self.client.loop_start()
+        listener = _start_log_listener()
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
         
-        print(f"[{datetime.now()}] Sensor Simulator started")
-        print("Simulating can arrival every 0.8-2.5 seconds")
-        print("=" * 60)
+        self.client.connect_async(self.broker, self.port, 60)
         
+        log.info("Sensor Simulator started")
+        log.info("Simulating can arrival every 0.8-2.5 seconds")
+        log.info("=" * 60)
+        
+        # Everything after this is driven by timers and valve commands.
+        self._schedule_next_can()
         try:
-            while True:
-                if not self.can_detected:
-                    self.generate_can_arrival()
-                
-                if self.filling_active:
-                    self.simulate_filling()
-                    
-                if self.can_detected and not self.filling_active and self.current_level > 0:
-                    self.can_detected = False
-                    self.current_level = 0
-                    print(f"[{datetime.now()}] Can #{self.can_counter} released")
-                    print("-" * 60)
-                    
-                time.sleep(0.1)
-                
-        except KeyboardInterrupt:
-            print("Shutting down sensor simulator...")
-            self.client.loop_stop()
-            self.client.disconnect()
+            self.client.loop_forever(retry_first_connection=True)
+        finally:
+            if listener:
+                listener.stop()
 
 if __name__ == "__main__":
-    import os
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+                        format="[%(asctime)s] %(message)s")
+    
     broker = os.getenv('MQTT_BROKER', 'localhost')
     port = int(os.getenv('MQTT_PORT', 1883))
+    seed = os.getenv('SIM_SEED')
     
     time.sleep(5)
     
-    simulator = SensorSimulator(broker=broker, port=port)
+    simulator = SensorSimulator(broker=broker, port=port,
+                                seed=int(seed) if seed is not None else None)
     simulator.run()